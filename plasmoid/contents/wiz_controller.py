@@ -8,6 +8,7 @@ import asyncio
 import json
 import sys
 import argparse
+import array
 import os
 import tempfile
 import time
@@ -22,12 +23,175 @@ except ImportError:
     print(json.dumps({"success": False, "message": "pywizlight not available in local lib directory"}))
     sys.exit(1)
 
+class _DatagramQueueProtocol(asyncio.DatagramProtocol):
+    """Forwards every datagram received on the endpoint to a queue"""
+    def __init__(self, queue):
+        self.queue = queue
+        self.error = None
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((data, addr))
+
+    def error_received(self, exc):
+        # Send errors (e.g. unreachable broadcast address) land here, not at sendto()
+        self.error = exc
+
+class FleetState:
+    """Compact per-bulb state table stored in preallocated column arrays indexed by MAC"""
+    MODE_UNKNOWN, MODE_RGB, MODE_TEMP, MODE_SCENE = 0, 1, 2, 3
+    MODE_NAMES = ("unknown", "rgb", "temp", "scene")
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.index = {}
+        self.macs = []
+        self.power = array.array('B', bytes(capacity))
+        self.dimming = array.array('B', bytes(capacity))
+        self.mode = array.array('B', bytes(capacity))
+        self.red = array.array('B', bytes(capacity))
+        self.green = array.array('B', bytes(capacity))
+        self.blue = array.array('B', bytes(capacity))
+        self.temp = array.array('H', [0]) * capacity
+        self.scene = array.array('H', [0]) * capacity
+        self.rtt = array.array('f', [0.0]) * capacity
+        self.last_seen = array.array('d', [0.0]) * capacity
+
+    def _columns(self):
+        return (self.power, self.dimming, self.mode, self.red, self.green, self.blue,
+                self.temp, self.scene, self.rtt, self.last_seen)
+
+    def _slot(self, mac):
+        """Return the row index for a MAC, allocating (and growing) if needed"""
+        row = self.index.get(mac)
+        if row is not None:
+            return row
+        if self.count == len(self.power):
+            for column in self._columns():
+                column.extend(array.array(column.typecode, [0]) * len(column))
+        row = self.count
+        self.index[mac] = row
+        self.macs.append(mac)
+        self.count += 1
+        return row
+
+    def update(self, mac, pilot, rtt=None):
+        """Store a getPilot result for a bulb, returns True if its light state changed
+
+        The previous RTT is kept when none was measured for this update.
+        """
+        before = None if mac not in self.index else self._light_state(self.index[mac])
+        row = self._slot(mac)
+        self.power[row] = 1 if pilot.get("state") else 0
+        self.dimming[row] = max(0, min(100, int(pilot.get("dimming", 0))))
+        self.scene[row] = max(0, min(65535, int(pilot.get("sceneId", 0))))
+        self.temp[row] = max(0, min(65535, int(pilot.get("temp", 0))))
+        self.red[row] = max(0, min(255, int(pilot.get("r", 0))))
+        self.green[row] = max(0, min(255, int(pilot.get("g", 0))))
+        self.blue[row] = max(0, min(255, int(pilot.get("b", 0))))
+        if self.scene[row]:
+            self.mode[row] = self.MODE_SCENE
+        elif self.temp[row]:
+            self.mode[row] = self.MODE_TEMP
+        elif any(k in pilot for k in ("r", "g", "b", "c", "w")):
+            self.mode[row] = self.MODE_RGB
+        else:
+            self.mode[row] = self.MODE_UNKNOWN
+        if rtt is not None:
+            self.rtt[row] = rtt
+        self.last_seen[row] = time.time()
+        return self._light_state(row) != before
+
+    def _light_state(self, row):
+        return (self.power[row], self.dimming[row], self.mode[row], self.red[row],
+                self.green[row], self.blue[row], self.temp[row], self.scene[row])
+
+    def get(self, mac):
+        """Return a bulb's state as a dict, or None if the MAC is unknown"""
+        row = self.index.get(mac)
+        if row is None:
+            return None
+        return self._row_to_dict(row)
+
+    def _row_to_dict(self, row):
+        return {
+            "mac": self.macs[row],
+            "state": bool(self.power[row]),
+            "brightness": self.dimming[row],
+            "mode": self.MODE_NAMES[self.mode[row]],
+            "rgb": [self.red[row], self.green[row], self.blue[row]],
+            "colortemp": self.temp[row],
+            "scene": self.scene[row],
+            "rtt": round(self.rtt[row], 2),
+            "last_seen": self.last_seen[row]
+        }
+
+    def all_on(self):
+        """MACs of every bulb that is switched on"""
+        return [mac for mac, on in zip(self.macs, self.power) if on]
+
+    def dimming_above(self, threshold):
+        """MACs of every switched-on bulb dimmed above the given percentage"""
+        threshold = int(threshold)
+        return [mac for mac, on, dim in zip(self.macs, self.power, self.dimming)
+                if on and dim > threshold]
+
+    def to_json(self, macs=None):
+        """Build the output list of bulb dicts, optionally limited to some MACs"""
+        rows = range(self.count) if macs is None else (self.index[mac] for mac in macs)
+        return [self._row_to_dict(row) for row in rows]
+
+    def memory_per_bulb(self):
+        """Measured bytes per preallocated slot and per tracked bulb"""
+        columns = sum(sys.getsizeof(column) for column in self._columns())
+        per_slot = columns / len(self.power)
+        if not self.count:
+            return {"per_slot": round(per_slot, 1), "count": 0}
+
+        index = sys.getsizeof(self.index) + sys.getsizeof(self.macs)
+        index += sum(sys.getsizeof(mac) for mac in self.macs)
+        return {
+            "per_slot": round(per_slot, 1),
+            "count": self.count,
+            "columns": round(columns / self.count, 1),
+            "index": round(index / self.count, 1),
+            "total": round((columns + index) / self.count, 1)
+        }
+
+    def save(self, path):
+        """Write the table to a compact file: a JSON header line followed by raw columns"""
+        with open(path, 'wb') as f:
+            f.write(json.dumps({"macs": self.macs}, separators=(',', ':')).encode() + b"\n")
+            for column in self._columns():
+                f.write(column[:self.count].tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Read a table written by save()"""
+        with open(path, 'rb') as f:
+            macs = json.loads(f.readline().decode())["macs"]
+            fleet = cls(capacity=max(64, len(macs)))
+            for column in fleet._columns():
+                size = len(macs) * column.itemsize
+                data = f.read(size)
+                if len(data) != size:
+                    raise ValueError("Truncated fleet state file")
+                values = array.array(column.typecode)
+                values.frombytes(data)
+                column[:len(macs)] = values
+        fleet.macs = macs
+        fleet.index = {mac: row for row, mac in enumerate(macs)}
+        fleet.count = len(macs)
+        return fleet
+
 class WizController:
     def __init__(self):
         self.bulb_ip = None
         self.light = None
+        self.bulbs = []
         self.cache_file = os.path.join(tempfile.gettempdir(), "wiz_bulb_cache.json")
+        self.fleet_file = os.path.join(tempfile.gettempdir(), "wiz_fleet_state.bin")
         self._load_cached_bulb()
+        self._load_fleet()
         
     def _load_cached_bulb(self):
         """Load cached bulb IP from file"""
@@ -39,16 +203,18 @@ class WizController:
                     cache_time = cache_data.get('timestamp', 0)
                     if time.time() - cache_time < 3600:  # 1 hour
                         self.bulb_ip = cache_data.get('ip')
+                        self.bulbs = cache_data.get('bulbs', [])
                         if self.bulb_ip:
                             self.light = wizlight(self.bulb_ip)
         except Exception:
             pass  # Ignore cache errors, will discover fresh
     
-    def _save_cached_bulb(self, ip):
-        """Save bulb IP to cache file"""
+    def _save_cached_bulb(self, ip, bulbs=None):
+        """Save bulb IP (and the full list of known bulbs) to cache file"""
         try:
             cache_data = {
                 'ip': ip,
+                'bulbs': bulbs or [],
                 'timestamp': time.time()
             }
             with open(self.cache_file, 'w') as f:
@@ -64,6 +230,31 @@ class WizController:
         except Exception:
             pass
 
+    def _load_fleet(self):
+        """Load the fleet state table kept from previous runs"""
+        self.fleet = FleetState()
+        try:
+            if os.path.exists(self.fleet_file):
+                self.fleet = FleetState.load(self.fleet_file)
+        except Exception:
+            pass  # Ignore fleet file errors, will poll fresh
+
+    def _save_fleet(self):
+        """Save the fleet state table for the next run"""
+        try:
+            self.fleet.save(self.fleet_file)
+        except Exception:
+            pass  # Ignore fleet save errors
+
+    def _clear_fleet(self):
+        """Clear the fleet state file"""
+        try:
+            if os.path.exists(self.fleet_file):
+                os.remove(self.fleet_file)
+        except Exception:
+            pass
+        self.fleet = FleetState()
+
     async def discover_bulbs(self):
         """Discover WiZ bulbs on the network"""
         try:
@@ -85,10 +276,11 @@ class WizController:
                         "port": 38899
                     })
                 
-                # Use first bulb and cache it
+                # Use first bulb and cache it, remember the rest for snapshots
                 self.bulb_ip = bulbs[0].ip
                 self.light = wizlight(self.bulb_ip)
-                self._save_cached_bulb(self.bulb_ip)
+                self.bulbs = bulb_list
+                self._save_cached_bulb(self.bulb_ip, bulb_list)
                 
                 return {"success": True, "bulbs": bulb_list}
             else:
@@ -97,6 +289,161 @@ class WizController:
         except Exception as e:
             return {"success": False, "message": str(e)}
 
+    async def discover_bulbs_stream(self, with_state=False, timeout=8.0):
+        """Discover bulbs, printing a JSON line for each one as soon as it replies"""
+        discovery_message = json.dumps({
+            "method": "registration",
+            "params": {
+                "phoneMac": "AAAAAAAAAAAA",
+                "register": False,
+                "phoneIp": "1.2.3.4",
+                "id": 1
+            }
+        }).encode()
+
+        transport = None
+        state_tasks = []
+        bulb_list = []
+        try:
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: _DatagramQueueProtocol(queue),
+                local_addr=("0.0.0.0", 0),
+                allow_broadcast=True
+            )
+
+            for addr in ["192.168.0.255", "192.168.1.255", "255.255.255.255"]:
+                transport.sendto(discovery_message, (addr, 38899))
+
+            seen = set()
+            deadline = loop.time() + timeout
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    data, addr = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+                try:
+                    response = json.loads(data.decode())
+                except Exception:
+                    continue
+                if not isinstance(response, dict) or response.get("method") != "registration":
+                    continue
+
+                result = response.get("result")
+                mac = result.get("mac") if isinstance(result, dict) else None
+                if not mac or mac in seen:
+                    continue
+                seen.add(mac)
+
+                bulb = {"ip": addr[0], "mac": mac, "port": 38899}
+                bulb_list.append(bulb)
+                print(json.dumps({"event": "bulb", "bulb": bulb}), flush=True)
+                if with_state:
+                    state_tasks.append(asyncio.create_task(self._emit_bulb_state(bulb)))
+
+            if state_tasks:
+                await asyncio.gather(*state_tasks)
+
+            if not bulb_list:
+                message = "No bulbs found"
+                if protocol.error:
+                    message += f" ({protocol.error})"
+                return {"success": False, "message": message}
+
+            self.bulb_ip = bulb_list[0]["ip"]
+            self.light = wizlight(self.bulb_ip)
+            self.bulbs = bulb_list
+            self._save_cached_bulb(self.bulb_ip, bulb_list)
+            return {"success": True, "bulbs": bulb_list}
+        except Exception as e:
+            for task in state_tasks:
+                task.cancel()
+            # Bulb lines may already be on stdout, so keep them in the result
+            return {"success": False, "message": str(e), "bulbs": bulb_list}
+        finally:
+            if transport:
+                transport.close()
+
+    async def _emit_bulb_state(self, bulb):
+        """Fetch a freshly discovered bulb's state and print it as a JSON line"""
+        results = await self._send_to_bulbs({bulb["ip"]: {"method": "getPilot", "params": {}}})
+        result = results[bulb["ip"]]
+        response = result.get("response") if result["success"] else None
+        if isinstance(response, dict) and "result" in response:
+            state = {"success": True, "state": response["result"]}
+        else:
+            state = {"success": False, "message": result.get("message", "Invalid response")}
+        print(json.dumps({"event": "state", "mac": bulb["mac"], "state": state}), flush=True)
+
+    async def _poll_bulbs(self, timeout=2.0):
+        """getPilot every known bulb at once, returns ([(bulb, pilot, rtt)], failed MACs)"""
+        if not self.bulbs:
+            discover_result = await self.discover_bulbs()
+            if not discover_result["success"]:
+                return [], []
+
+        get_pilot = {"method": "getPilot", "params": {}}
+        results = await self._send_to_bulbs({b["ip"]: get_pilot for b in self.bulbs}, timeout)
+
+        polled = []
+        failed = []
+        for bulb in self.bulbs:
+            result = results[bulb["ip"]]
+            response = result.get("response") if result["success"] else None
+            pilot = response.get("result") if isinstance(response, dict) else None
+            if isinstance(pilot, dict):
+                polled.append((bulb, pilot, result["rtt"]))
+            else:
+                failed.append(bulb["mac"])
+        return polled, failed
+
+    async def refresh_fleet(self):
+        """Poll every known bulb concurrently and update the fleet state table"""
+        polled, failed = await self._poll_bulbs()
+        for bulb, pilot, rtt in polled:
+            self.fleet.update(bulb["mac"], pilot, rtt)
+        if polled:
+            self._save_fleet()
+        return failed
+
+    def _record_pilot(self, pilot):
+        """Record a single polled bulb in the fleet table, saving only on change"""
+        try:
+            if pilot and pilot.get("mac") and self.fleet.update(pilot["mac"], pilot):
+                self._save_fleet()
+        except Exception:
+            pass  # The fleet table must never break a successful state read
+
+    async def get_fleet_state(self, query=None, threshold=50):
+        """Get the state of all known bulbs, optionally filtered by "on" or "above" """
+        try:
+            failed = await self.refresh_fleet()
+            if not self.fleet.count:
+                return {"success": False, "message": "No bulbs found", "failed": failed}
+
+            if query == "on":
+                macs = self.fleet.all_on()
+            elif query == "above":
+                macs = self.fleet.dimming_above(threshold)
+            elif query is None:
+                macs = None
+            else:
+                return {"success": False, "message": f"Unknown fleet query: {query}"}
+
+            return {
+                "success": True,
+                "bulbs": self.fleet.to_json(macs),
+                "failed": failed,
+                "memory_per_bulb": self.fleet.memory_per_bulb()
+            }
+        except Exception as e:
+            return {"success": False, "message": str(e)}
+
     async def ensure_connected(self):
         """Ensure we have a connection to a bulb"""
         if not self.light:
@@ -112,6 +459,7 @@ class WizController:
                 return {"success": False, "message": "No bulb found"}
             
             state = await self.light.updateState()
+            self._record_pilot(getattr(state, "pilotResult", None))
             return {
                 "success": True, 
                 "state": {
@@ -272,6 +620,171 @@ class WizController:
         ]
         return {"success": True, "scenes": scenes}
 
+    def _snapshot_file(self, name):
+        """Path of the snapshot file for the given snapshot name"""
+        safe_name = "".join(c for c in str(name) if c.isalnum() or c in "-_") or "default"
+        return os.path.join(tempfile.gettempdir(), f"wiz_snapshot_{safe_name}.json")
+
+    @staticmethod
+    def _pilot_to_payload(pilot):
+        """Reduce a getPilot result to the minimal setPilot params that recreate it"""
+        if not pilot.get("state", False):
+            return {"state": False}
+
+        payload = {"state": True}
+        scene_id = pilot.get("sceneId", 0)
+        if scene_id:
+            payload["sceneId"] = scene_id
+            if "speed" in pilot:
+                payload["speed"] = pilot["speed"]
+        elif pilot.get("temp"):
+            payload["temp"] = pilot["temp"]
+        elif any(k in pilot for k in ("r", "g", "b", "c", "w")):
+            for key in ("r", "g", "b", "c", "w"):
+                if key in pilot:
+                    payload[key] = pilot[key]
+
+        if "dimming" in pilot:
+            payload["dimming"] = pilot["dimming"]
+        return payload
+
+    async def _send_to_bulbs(self, commands, timeout=2.0, resend_interval=0.2):
+        """Send one command per bulb IP from a single socket, returns {ip: result}
+
+        All requests go out at once and the replies are collected against one
+        shared deadline. Bulbs that have not answered yet get the command
+        again every resend_interval, so a lost datagram only costs one interval.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        results = {ip: {"success": False, "message": "timeout"} for ip in commands}
+        pending = set(commands)
+        messages = {ip: json.dumps(command).encode() for ip, command in commands.items()}
+        sent_at = {}
+
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramQueueProtocol(queue),
+            local_addr=("0.0.0.0", 0)
+        )
+
+        def send_pending():
+            for ip in list(pending):
+                try:
+                    transport.sendto(messages[ip], (ip, 38899))
+                    sent_at[ip] = loop.time()
+                except Exception as e:
+                    results[ip] = {"success": False, "message": str(e)}
+                    pending.discard(ip)
+
+        try:
+            deadline = loop.time() + timeout
+            send_pending()
+            next_resend = loop.time() + resend_interval
+            while pending:
+                now = loop.time()
+                if now >= deadline:
+                    break
+                if now >= next_resend:
+                    send_pending()
+                    next_resend = now + resend_interval
+                    continue
+                try:
+                    data, addr = await asyncio.wait_for(
+                        queue.get(), min(deadline, next_resend) - now
+                    )
+                except asyncio.TimeoutError:
+                    continue
+
+                if addr[0] not in pending:
+                    continue
+                try:
+                    response = json.loads(data.decode())
+                except Exception:
+                    continue
+
+                pending.discard(addr[0])
+                results[addr[0]] = {
+                    "success": True,
+                    "response": response,
+                    "rtt": (loop.time() - sent_at[addr[0]]) * 1000
+                }
+        finally:
+            transport.close()
+
+        return results
+
+    async def snapshot(self, name="default"):
+        """Capture the current state of every known bulb into a named snapshot"""
+        try:
+            polled, failed = await self._poll_bulbs()
+            if not polled and not failed:
+                return {"success": False, "message": "No bulbs found"}
+
+            snapshot_bulbs = {}
+            for bulb, pilot, rtt in polled:
+                self.fleet.update(bulb["mac"], pilot, rtt)
+                snapshot_bulbs[bulb["mac"]] = {
+                    "ip": bulb["ip"],
+                    "pilot": self._pilot_to_payload(pilot)
+                }
+            if polled:
+                self._save_fleet()
+
+            if not snapshot_bulbs:
+                return {"success": False, "message": "No bulb responded", "failed": failed}
+
+            with open(self._snapshot_file(name), 'w') as f:
+                json.dump({
+                    "name": name,
+                    "timestamp": time.time(),
+                    "bulbs": snapshot_bulbs
+                }, f, separators=(',', ':'))
+
+            return {"success": True, "name": name, "count": len(snapshot_bulbs), "failed": failed}
+        except Exception as e:
+            return {"success": False, "message": str(e)}
+
+    async def restore(self, name="default"):
+        """Push a named snapshot back to its bulbs"""
+        try:
+            snapshot_file = self._snapshot_file(name)
+            if not os.path.exists(snapshot_file):
+                return {"success": False, "message": f"Snapshot not found: {name}"}
+
+            with open(snapshot_file, 'r') as f:
+                snapshot_bulbs = json.load(f).get("bulbs", {})
+
+            # A bulb can only take one payload per batch; if two MACs ended up
+            # with the same IP (e.g. DHCP reassignment) the later ones fail
+            commands = {}
+            failed = []
+            for mac, entry in snapshot_bulbs.items():
+                if entry["ip"] in commands:
+                    failed.append(mac)
+                    continue
+                commands[entry["ip"]] = {"method": "setPilot", "params": entry["pilot"]}
+
+            results = await self._send_to_bulbs(commands)
+
+            for mac, entry in snapshot_bulbs.items():
+                if mac in failed:
+                    continue
+                result = results[entry["ip"]]
+                response = result.get("response") if result["success"] else None
+                if not isinstance(response, dict) or "result" not in response:
+                    failed.append(mac)
+
+            restored = len(snapshot_bulbs) - len(failed)
+            return {
+                "success": not failed,
+                "partial": bool(failed) and restored > 0,
+                "name": name,
+                "count": restored,
+                "failed": failed
+            }
+        except Exception as e:
+            return {"success": False, "message": str(e)}
+
     async def send_command(self, command):
         """Send a command directly to the bulb using UDP (like the old controller)"""
         if not self.bulb_ip:
@@ -340,6 +853,12 @@ async def main():
             else:
                 result = discover_result
                 
+        elif args.command == "discoverStream":
+            result = await controller.discover_bulbs_stream()
+            
+        elif args.command == "discoverStreamAndGetState":
+            result = await controller.discover_bulbs_stream(with_state=True)
+            
         elif args.command == "getState":
             result = await controller.get_state()
             
@@ -391,11 +910,25 @@ async def main():
             
         elif args.command == "clearCache":
             controller._clear_cache()
+            controller._clear_fleet()
             # Reset the controller state
             controller.bulb_ip = None
             controller.light = None
             result = {"success": True, "message": "Cache cleared successfully"}
             
+        elif args.command == "snapshot":
+            name = args.args[0] if args.args else "default"
+            result = await controller.snapshot(name)
+            
+        elif args.command == "restore":
+            name = args.args[0] if args.args else "default"
+            result = await controller.restore(name)
+            
+        elif args.command == "getFleetState":
+            query = args.args[0] if args.args else None
+            threshold = args.args[1] if len(args.args) > 1 else 50
+            result = await controller.get_fleet_state(query, threshold)
+            
         elif args.command == "sendRawCommand":
             if len(args.args) < 1:
                 result = {"success": False, "message": "JSON command required"}
@@ -37,6 +37,7 @@ class WizController:
         
         message = json.dumps(discovery_message).encode()
         bulbs = []
+        seen_macs = set()
         
         # Try different broadcast addresses
         broadcast_addresses = ["192.168.0.255", "192.168.1.255", "255.255.255.255"]
@@ -63,7 +64,8 @@ class WizController:
                         }
                         
                         # Check if already found this bulb
-                        if not any(b["mac"] == bulb["mac"] for b in bulbs):
+                        if bulb["mac"] not in seen_macs:
+                            seen_macs.add(bulb["mac"])
                             bulbs.append(bulb)
                             
                 except socket.timeout: